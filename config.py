@@ -35,6 +35,7 @@ def ensure_config():
                 {"id": str(d+1), "status": "empty"} for d in range(desk_count)
             ]
         data["tickets"] = {}
+        data["counters"] = {}
         data["clerks"] = {}
         save_data(data)
         print("Configuration saved to queue_data.json")
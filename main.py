@@ -1,17 +1,32 @@
 import time
-import json, uuid
-from typing import Dict, List, Tuple, Optional
+import uuid
+import asyncio
+import os
+from collections import defaultdict, deque
+from functools import lru_cache
+from typing import Deque, Dict, Set, Tuple, Optional
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, Request
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response
 from contextlib import asynccontextmanager
+import orjson
 
 app = FastAPI()
 
 DATA_FILE = "queue_data.json"
+# Compact by default; set ECHOWAIT_PRETTY=1 to get an indented file for debugging
+DATA_FILE_OPTIONS = orjson.OPT_INDENT_2 if os.environ.get("ECHOWAIT_PRETTY") == "1" else 0
 
-import json
-
-DATA_FILE = "queue_data.json"
+def write_data_file(content: bytes):
+    """
+    Replace DATA_FILE atomically so a crash mid-write can't leave it empty or
+    truncated: write a temp file, fsync it, then rename it over the original.
+    """
+    tmp_path = DATA_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, DATA_FILE)
 
 def init_data_file():
     """
@@ -21,15 +36,15 @@ def init_data_file():
     default_structure = {
         "desks": {},
         "tickets": {},
-        "sessions": {}
+        "sessions": {},
+        "counters": {}
     }
 
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(default_structure, f, indent=2)
+        with open(DATA_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        write_data_file(orjson.dumps(default_structure, option=DATA_FILE_OPTIONS))
         print("[init_data_file] Created new data file with default structure.")
         return default_structure
 
@@ -39,6 +54,8 @@ def init_data_file():
         data["tickets"] = {}
     if "sessions" not in data or not isinstance(data["sessions"], dict):
         data["sessions"] = {}
+    if "counters" not in data or not isinstance(data["counters"], dict):
+        data["counters"] = {}
 
     normalized_count = 0
     for service, tickets in data["tickets"].items():
@@ -50,28 +67,76 @@ def init_data_file():
                 normalized_count += 1
                 print(f"[init_data_file] Normalized ticket {ticket['id']} ({service}) → waiting")
 
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    write_data_file(orjson.dumps(data, option=DATA_FILE_OPTIONS))
 
     print(f"[init_data_file] Completed normalization. {normalized_count} ticket(s) updated.")
     return data
 
 
-def load_data():
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"desks": {}, "tickets": {}, "sessions": {}}
-
-def save_data(data):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
-
-# Initialize JSON file at server start
-init_data_file()
-
+# Initialize JSON file at server start; STATE is the authoritative copy from here on
+STATE = init_data_file()
+
+# Reverse index of STATE["sessions"]: (service, desk_id) -> session id owning that desk
+SESSION_BY_DESK: Dict[Tuple[str, str], str] = {}
+# Sessions are stored in creation order, so the newest claim on a desk wins, as at runtime
+for _sid, _info in STATE["sessions"].items():
+    SESSION_BY_DESK[(_info["service"], _info["desk_id"])] = _sid
+
+# --- Persistence ---
+PERSIST_DELAY = 0.05  # seconds; bursts of mutations inside this window share one write
+PERSIST_RETRY_DELAY = 1.0  # seconds to wait before retrying a failed write
+FLUSH_TIMEOUT = 5.0  # seconds shutdown waits for a pending write
+_dirty = False
+_persist_task: Optional[asyncio.Task] = None
+# Encoded desks/tickets/sessions for /state; None until rebuilt after a mutation
+_state_json: Optional[bytes] = None
+
+async def persist():
+    """Write STATE to disk once the current burst of mutations has settled."""
+    global _dirty
+    while _dirty:
+        await asyncio.sleep(PERSIST_DELAY)
+        _dirty = False
+        # Serialize on the event loop so handlers can't mutate STATE mid-dump
+        content = orjson.dumps(STATE, option=DATA_FILE_OPTIONS)
+        try:
+            await asyncio.to_thread(write_data_file, content)
+        except Exception as e:
+            # Keep STATE marked dirty so the write is retried instead of silently lost
+            print(f"[persist] Failed to write {DATA_FILE}: {e!r}; retrying in {PERSIST_RETRY_DELAY}s")
+            _dirty = True
+            await asyncio.sleep(PERSIST_RETRY_DELAY)
+
+def mark_dirty():
+    """Flag STATE as changed and make sure a persist task is pending."""
+    global _dirty, _persist_task, _state_json
+    _dirty = True
+    _state_json = None
+    if _persist_task is None or _persist_task.done():
+        _persist_task = asyncio.create_task(persist())
+
+async def flush_state():
+    """Wait for any pending write to land (used on shutdown)."""
+    if _persist_task is not None and not _persist_task.done():
+        try:
+            await asyncio.wait_for(_persist_task, FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"[flush_state] Gave up after {FLUSH_TIMEOUT}s; latest state was NOT saved to {DATA_FILE}")
+
+# Last (minute, "HH:MM") pair; event timestamps only have minute resolution
+_TS_CACHE = [-1, ""]
+
+def hm_now() -> str:
+    now = int(time.time())
+    minute = now // 60
+    if minute != _TS_CACHE[0]:
+        _TS_CACHE[0] = minute
+        _TS_CACHE[1] = time.strftime("%H:%M", time.localtime(now))
+    return _TS_CACHE[1]
+
+@lru_cache(maxsize=None)
 def load_html(filename: str) -> str:
+    # Templates don't change at runtime; read each one from disk only once
     with open(f"templates/{filename}", "r", encoding="utf-8") as f:
         return f.read()
     
@@ -79,105 +144,124 @@ def load_html(filename: str) -> str:
 class QueueSystem:
     def __init__(self):
         # In‑memory queues per service
-        self.queues: Dict[str, List[str]] = {}
-        # Ticket counters per service
+        self.queues: Dict[str, Deque[str]] = {}
+        # Ticket counters per service (same dict as STATE["counters"] once restored)
         self.ticket_counter: Dict[str, int] = {}
         # Assigned tickets per (service, desk)
         self.assigned: Dict[Tuple[str, str], Optional[str]] = {}
         # Serving tickets per (service, desk)
         self.serving: Dict[Tuple[str, str], Optional[str]] = {}
+        # Number of desks each (service, ticket) is assigned to, mirrors self.assigned
+        self.assigned_count: Dict[Tuple[str, str], int] = defaultdict(int)
+        # Indexes into STATE: service -> id -> the same dict stored in the JSON lists
+        self.tickets_by_id: Dict[str, Dict[str, dict]] = {}
+        self.desks_by_id: Dict[str, Dict[str, dict]] = {}
 
         # Restore state from JSON when server starts
         self.restore_state()
 
     def restore_state(self):
         """Rehydrate queues, assigned, and serving from JSON persistence."""
-        data = load_data()
+        data = STATE
+
+        # Counters are persisted as-is, so generate_ticket updates STATE directly
+        self.ticket_counter = data["counters"]
 
-        # Restore queues from waiting tickets
+        # Restore index and waiting queue in a single pass per service
         for service, tickets in data.get("tickets", {}).items():
-            self.queues[service] = [t["id"] for t in tickets if t["status"] == "waiting"]
-            # Restore ticket counter to max id number
-            if tickets:
-                max_num = max(int(t["id"].split("-")[1]) for t in tickets)
-                self.ticket_counter[service] = max_num
+            by_id = self.tickets_by_id[service] = {}
+            queue = self.queues[service] = deque()
+            for t in tickets:
+                by_id[t["id"]] = t
+                if t["status"] == "waiting":
+                    queue.append(t["id"])
+            # Files written before counters were persisted: recover from the ticket ids
+            if tickets and service not in self.ticket_counter:
+                self.ticket_counter[service] = max(int(t["id"].split("-")[1]) for t in tickets)
 
         # Restore desk assignments
         for service, desks in data.get("desks", {}).items():
+            self.desks_by_id[service] = {d["id"]: d for d in desks}
             for desk in desks:
                 current_ticket = desk.get("current_ticket")
                 if current_ticket:
                     self.assigned[(service, desk["id"])] = current_ticket
+                    self.assigned_count[(service, current_ticket)] += 1
                     # Check ticket status to decide if serving
-                    ticket_info = next(
-                        (t for t in data["tickets"].get(service, []) if t["id"] == current_ticket),
-                        None
-                    )
+                    ticket_info = self.get_ticket(service, current_ticket)
                     if ticket_info and ticket_info["status"] == "serving":
                         self.serving[(service, desk["id"])] = current_ticket
 
     def generate_ticket(self, service: str) -> str:
         if service not in self.ticket_counter:
             self.ticket_counter[service] = 0
-            self.queues[service] = []
+        if service not in self.queues:
+            self.queues[service] = deque()
         self.ticket_counter[service] += 1
         ticket = f"{service[:1].upper()}-{self.ticket_counter[service]}"
         self.queues[service].append(ticket)
 
         # Persist ticket
-        data = load_data()
-        if service not in data["tickets"]:
-            data["tickets"][service] = []
-        data["tickets"][service].append({"id": ticket, "status": "waiting"})
-        save_data(data)
+        if service not in STATE["tickets"]:
+            STATE["tickets"][service] = []
+        ticket_info = {"id": ticket, "status": "waiting"}
+        STATE["tickets"][service].append(ticket_info)
+        self.tickets_by_id.setdefault(service, {})[ticket] = ticket_info
+        mark_dirty()
 
         return ticket
 
-    def add_ticket(self, service: str, ticket_id: str):
-        """Add an existing ticket back into the waiting queue (e.g. from JSON)."""
-        if service not in self.queues:
-            self.queues[service] = []
-        if ticket_id not in self.queues[service]:
-            self.queues[service].append(ticket_id)
+    def get_ticket(self, service: str, ticket_id: Optional[str]) -> Optional[dict]:
+        return self.tickets_by_id.get(service, {}).get(ticket_id)
+
+    def get_desk(self, service: str, desk_id: str) -> Optional[dict]:
+        return self.desks_by_id.get(service, {}).get(desk_id)
 
     def next_ticket(self, service: str) -> Optional[str]:
         if service not in self.queues or not self.queues[service]:
             return None
-        return self.queues[service].pop(0)
+        return self.queues[service].popleft()
 
     def queue_length(self, service: str) -> int:
         return len(self.queues.get(service, []))
 
     def set_assigned(self, service: str, desk: str, ticket: Optional[str]):
+        prev = self.assigned.get((service, desk))
+        if prev is not None:
+            self.assigned_count[(service, prev)] -= 1
+            if not self.assigned_count[(service, prev)]:
+                del self.assigned_count[(service, prev)]
+        if ticket is not None:
+            self.assigned_count[(service, ticket)] += 1
         self.assigned[(service, desk)] = ticket
         # Persist desk assignment
-        data = load_data()
-        for d in data["desks"].get(service, []):
-            if d["id"] == desk:
-                d["current_ticket"] = ticket
-        save_data(data)
+        desk_info = self.get_desk(service, desk)
+        if desk_info:
+            desk_info["current_ticket"] = ticket
+        mark_dirty()
 
     def get_assigned(self, service: str, desk: str) -> Optional[str]:
         return self.assigned.get((service, desk))
 
+    def is_assigned(self, service: str, ticket: str) -> bool:
+        return self.assigned_count.get((service, ticket), 0) > 0
+
     def set_serving(self, service: str, desk: str, ticket: Optional[str]):
         self.serving[(service, desk)] = ticket
 
         # Persist serving state
-        data = load_data()
-
         # Update ticket status
-        for t in data["tickets"].get(service, []):
-            if t["id"] == ticket:
-                t["status"] = "serving"
+        ticket_info = self.get_ticket(service, ticket)
+        if ticket_info:
+            ticket_info["status"] = "serving"
 
         # Update desk state
-        for d in data["desks"].get(service, []):
-            if d["id"] == desk:
-                d["current_ticket"] = ticket   # <-- persist ticket ID here
-                d["status"] = "occupied"
+        desk_info = self.get_desk(service, desk)
+        if desk_info:
+            desk_info["current_ticket"] = ticket   # <-- persist ticket ID here
+            desk_info["status"] = "occupied"
 
-        save_data(data)
+        mark_dirty()
 
 
     def get_serving(self, service: str, desk: str) -> Optional[str]:
@@ -189,43 +273,116 @@ queue_system = QueueSystem()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup logic
-    data = init_data_file()  # normalize JSON and return it
+    # Startup logic: STATE was already normalized by init_data_file() at import,
+    # and queue_system.restore_state() rebuilt the waiting queues from it
+    waiting = sum(len(q) for q in queue_system.queues.values())
+    print(f"[lifespan] Restored {waiting} waiting ticket(s) across {len(queue_system.queues)} service(s)")
 
-    # Rebuild queue_system from tickets in JSON
-    for service, tickets in data.get("tickets", {}).items():
-        for ticket in tickets:
-            if ticket.get("status") == "waiting":
-                queue_system.add_ticket(service, ticket["id"])
-                print(f"[lifespan] Restored ticket {ticket['id']} into {service} queue")
+    flusher = asyncio.create_task(manager.run_flusher())
 
     yield
 
-    # Shutdown logic (optional)
+    flusher.cancel()
+
+    # Shutdown logic: make sure the last mutations reach disk
+    await flush_state()
     print("[lifespan] Server shutting down.")
 
 app = FastAPI(lifespan=lifespan)
 
 # --- Connection management ---
+BROADCAST_INTERVAL = 0.05  # seconds of events coalesced into one frame
+BROADCAST_MAX_EVENTS = 100
+# Fixed envelope for batched frames; pre-encoded events are spliced in between
+MULTI_FRAME_PREFIX = b'{"type":"multi","events":['
+MULTI_FRAME_SUFFIX = b']}'
+CLIENT_QUEUE_SIZE = 32  # pending frames per client before it is considered too slow
+
+class ChannelClient:
+    """A connected WebSocket plus its outgoing frame queue and relay task."""
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.relay_task: Optional[asyncio.Task] = None
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # Keyed by socket so connect/disconnect are O(1)
+        self.active_connections: Dict[WebSocket, ChannelClient] = {}
+        # Encoded events waiting to be sent by run_flusher()
+        self.event_buffer: asyncio.Queue = asyncio.Queue()
+        # Strong refs to in-flight close tasks so they aren't garbage-collected early
+        self._close_tasks: Set[asyncio.Task] = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = ChannelClient(websocket)
+        client.relay_task = asyncio.create_task(self._relay(client))
+        self.active_connections[websocket] = client
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: str):
-        for connection in list(self.active_connections):
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            self._drop(client)
+
+    def _drop(self, client: ChannelClient):
+        self.active_connections.pop(client.websocket, None)
+        if client.relay_task is not None:
+            client.relay_task.cancel()
+
+    async def _relay(self, client: ChannelClient):
+        # Each client drains its own queue, so a congested socket only delays itself
+        try:
+            while True:
+                message = await client.queue.get()
+                await client.websocket.send_bytes(message)
+        except Exception:
+            self.active_connections.pop(client.websocket, None)
+
+    def broadcast(self, message: bytes):
+        # message is already UTF-8 JSON, encoded once and shared by every client
+        slow_clients = []
+        for client in self.active_connections.values():
             try:
-                await connection.send_text(message)
-            except Exception:
-                if connection in self.active_connections:
-                    self.active_connections.remove(connection)
+                client.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                slow_clients.append(client)
+
+        # Clients that can't keep up are disconnected rather than buffered without bound;
+        # done after the loop so the dict isn't resized while being iterated
+        for client in slow_clients:
+            print("[broadcast] Dropping slow client")
+            self._drop(client)
+            task = asyncio.create_task(self._close(client.websocket))
+            self._close_tasks.add(task)
+            task.add_done_callback(self._close_tasks.discard)
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def enqueue(self, event: dict):
+        # Encode once here so the flusher only has to concatenate bytes
+        await self.event_buffer.put(orjson.dumps(event))
+
+    async def run_flusher(self):
+        """
+        Drain event_buffer forever, sending everything that arrives within
+        BROADCAST_INTERVAL as a single {"type": "multi", "events": [...]} frame.
+        """
+        while True:
+            events = [await self.event_buffer.get()]
+            await asyncio.sleep(BROADCAST_INTERVAL)
+            while len(events) < BROADCAST_MAX_EVENTS and not self.event_buffer.empty():
+                events.append(self.event_buffer.get_nowait())
+
+            if len(events) == 1:
+                message = events[0]
+            else:
+                message = MULTI_FRAME_PREFIX + b",".join(events) + MULTI_FRAME_SUFFIX
+            self.broadcast(message)
 
 
 manager = ConnectionManager()
@@ -249,94 +406,79 @@ async def display():
 @app.get("/ticket")
 async def get_ticket(service: str = Query(...)):
     ticket = queue_system.generate_ticket(service)
-    timestamp = time.strftime("%H:%M")
-    payload = json.dumps({
+    timestamp = hm_now()
+    await manager.enqueue({
         "type": "issued",
         "timestamp": timestamp,
         "service": service,
         "ticket": ticket,
         "queue_length": queue_system.queue_length(service),
     })
-    await manager.broadcast(payload)
     return {"ticket": ticket}
 
 
 @app.get("/next")
 async def next_ticket(service: str = Query(...), desk: str = Query(...)):
-    data = load_data()
-
-    # Collect waiting tickets for this service
-    waiting_tickets = [t for t in data["tickets"].get(service, []) if t["status"] == "waiting"]
-    waiting_count = len(waiting_tickets)
-
-    # Case A: Only 1 ticket waiting
-    if waiting_count == 1:
-        single_ticket = waiting_tickets[0]["id"]
+    # Case A: Only 1 ticket waiting (the queue holds exactly the waiting tickets)
+    if queue_system.queue_length(service) == 1:
+        single_ticket = queue_system.queues[service][0]
         # Check if that single ticket is already assigned
-        for (svc, _desk), assigned_ticket in queue_system.assigned.items():
-            if svc == service and assigned_ticket == single_ticket:
-                return {
-                    "status": "busy",
-                    "ticket": assigned_ticket,
-                    "message": f"Ticket {assigned_ticket} already assigned for {service}."
-                }
+        if queue_system.is_assigned(service, single_ticket):
+            return {
+                "status": "busy",
+                "ticket": single_ticket,
+                "message": f"Ticket {single_ticket} already assigned for {service}."
+            }
 
     # Case B: More than 1 tickets waiting
     # → allow each desk to get the next unassigned ticket
     ticket = queue_system.next_ticket(service)
-    timestamp = time.strftime("%H:%M")
+    timestamp = hm_now()
 
     if not ticket:
-        payload = json.dumps({
+        await manager.enqueue({
             "type": "empty",
             "timestamp": timestamp,
             "service": service,
             "message": f"No tickets waiting for {service}."
         })
-        await manager.broadcast(payload)
         return {"status": "empty"}
 
     # Assign ticket to desk
     queue_system.set_assigned(service, desk, ticket)
 
     # Update JSON status
-    for t in data["tickets"].get(service, []):
-        if t["id"] == ticket:
-            t["status"] = "assigned"
-    save_data(data)
+    ticket_info = queue_system.get_ticket(service, ticket)
+    if ticket_info:
+        ticket_info["status"] = "assigned"
+    mark_dirty()
 
     # Broadcast event
-    payload = json.dumps({
+    await manager.enqueue({
         "type": "called",
         "timestamp": timestamp,
         "service": service,
         "ticket": ticket,
         "desk": desk,
     })
-    await manager.broadcast(payload)
 
     return {"status": "ok", "ticket": ticket, "desk": desk}
 
 
 @app.get("/clerk/{service}/{desk_id}")
 async def clerk_select(service: str, desk_id: str, request: Request, status: str = Query(None)):
-    data = load_data()
+    data = STATE
     session_id = request.cookies.get("session_id")
 
     # Find desk
-    desks = data["desks"].get(service, [])
-    desk = next((d for d in desks if d["id"] == desk_id), None)
+    desk = queue_system.get_desk(service, desk_id)
     if not desk:
         return JSONResponse({"error": "Desk not found"}, status_code=404)
 
     # Case 1: Desk occupied
     if desk["status"] == "occupied":
         # Find which session owns this desk
-        owner_session = None
-        for sid, info in data["sessions"].items():
-            if info["service"] == service and info["desk_id"] == desk_id:
-                owner_session = sid
-                break
+        owner_session = SESSION_BY_DESK.get((service, desk_id))
 
         if owner_session and owner_session == session_id:
             # Current browser owns this desk → Back to desk
@@ -349,7 +491,8 @@ async def clerk_select(service: str, desk_id: str, request: Request, status: str
     new_session = str(uuid.uuid4())
     desk["status"] = "occupied"
     data["sessions"][new_session] = {"service": service, "desk_id": desk_id}
-    save_data(data)
+    SESSION_BY_DESK[(service, desk_id)] = new_session
+    mark_dirty()
 
     response = RedirectResponse(url=f"/clerk/{service}/{desk_id}/occupied")
     response.set_cookie("session_id", new_session)
@@ -361,7 +504,7 @@ async def clerk_page(service: str, desk_id: str, request: Request):
     Clerk working page after desk is marked occupied.
     Only accessible if session cookie matches.
     """
-    data = load_data()
+    data = STATE
     session_id = request.cookies.get("session_id")
 
     if not session_id or session_id not in data.get("sessions", {}):
@@ -381,7 +524,7 @@ async def confirm_ticket(
     ticket: str = Query(...)
 ):
     assigned = queue_system.get_assigned(service, desk)
-    timestamp = time.strftime("%H:%M")
+    timestamp = hm_now()
 
     if assigned != ticket:
         return {"status": "error", "message": "Ticket mismatch or no ticket assigned."}
@@ -391,31 +534,28 @@ async def confirm_ticket(
     queue_system.set_assigned(service, desk, None)
 
     # Update JSON status
-    data = load_data()
-
     # Update ticket status and persist desk info
-    for t in data["tickets"].get(service, []):
-        if t["id"] == ticket:
-            t["status"] = "serving"
-            t["desk"] = desk   # <-- persist desk here
+    ticket_info = queue_system.get_ticket(service, ticket)
+    if ticket_info:
+        ticket_info["status"] = "serving"
+        ticket_info["desk"] = desk   # <-- persist desk here
 
     # Update desk state with current_ticket
-    for d in data["desks"].get(service, []):
-        if d["id"] == desk:
-            d["status"] = "occupied"
-            d["current_ticket"] = ticket
+    desk_info = queue_system.get_desk(service, desk)
+    if desk_info:
+        desk_info["status"] = "occupied"
+        desk_info["current_ticket"] = ticket
 
-    save_data(data)
+    mark_dirty()
 
     # Broadcast event
-    payload = json.dumps({
+    await manager.enqueue({
         "type": "serving",
         "timestamp": timestamp,
         "service": service,
         "ticket": ticket,
         "desk": desk,
     })
-    await manager.broadcast(payload)
 
     return {"status": "ok", "ticket": ticket, "desk": desk}
 
@@ -427,7 +567,7 @@ async def done_ticket(
     ticket: str = Query(...)
 ):
     current_serving = queue_system.get_serving(service, desk)
-    timestamp = time.strftime("%H:%M")
+    timestamp = hm_now()
 
     if current_serving != ticket:
         return {"status": "error", "message": "No matching serving ticket for this desk."}
@@ -435,51 +575,52 @@ async def done_ticket(
     queue_system.set_serving(service, desk, None)
 
     # Update JSON status
-    data = load_data()
-    for t in data["tickets"].get(service, []):
-        if t["id"] == ticket:
-            t["status"] = "done"
-            t["desk"] = None   # <-- clear desk info
-    for d in data["desks"].get(service, []):
-        if d["id"] == desk:
-            d["current_ticket"] = None
-            d["status"] = "occupied"  # or "empty" if you want to free the desk
-    save_data(data)
-
-    payload = json.dumps({
+    ticket_info = queue_system.get_ticket(service, ticket)
+    if ticket_info:
+        ticket_info["status"] = "done"
+        ticket_info["desk"] = None   # <-- clear desk info
+    desk_info = queue_system.get_desk(service, desk)
+    if desk_info:
+        desk_info["current_ticket"] = None
+        desk_info["status"] = "occupied"  # or "empty" if you want to free the desk
+    mark_dirty()
+
+    await manager.enqueue({
         "type": "done",
         "timestamp": timestamp,
         "service": service,
         "ticket": ticket,
         "desk": desk,
     })
-    await manager.broadcast(payload)
 
     return {"status": "ok", "ticket": ticket, "desk": desk}
 
 
 @app.get("/state")
 async def get_state(request: Request):
-    data = load_data()
+    global _state_json
+    data = STATE
     session_id = request.cookies.get("session_id")
-    return JSONResponse({
-        "desks": data.get("desks", {}),
-        "tickets": data.get("tickets", {}),
-        "sessions": data.get("sessions", {}),
-        "currentSession": session_id
-    })
+    if _state_json is None:
+        _state_json = orjson.dumps({
+            "desks": data.get("desks", {}),
+            "tickets": data.get("tickets", {}),
+            "sessions": data.get("sessions", {}),
+        })
+    # Only currentSession differs per request; splice it onto the cached object
+    body = _state_json[:-1] + b',"currentSession":' + orjson.dumps(session_id) + b"}"
+    return Response(content=body, media_type="application/json")
 
 @app.get("/clerk_state")
 async def clerk_state(service: str = Query(...), desk: str = Query(...)):
-    data = load_data()
-    desk_info = next((d for d in data["desks"].get(service, []) if d["id"] == desk), None)
+    desk_info = queue_system.get_desk(service, desk)
     if not desk_info:
         return {"service": service, "desk": desk, "assigned": None, "serving": None}
 
     current_ticket = desk_info.get("current_ticket")
     if current_ticket:
         # Find ticket status
-        ticket_info = next((t for t in data["tickets"].get(service, []) if t["id"] == current_ticket), None)
+        ticket_info = queue_system.get_ticket(service, current_ticket)
         if ticket_info and ticket_info["status"] == "serving":
             return {"service": service, "desk": desk, "serving": current_ticket}
         elif ticket_info and ticket_info["status"] == "assigned":
@@ -506,5 +647,14 @@ async def websocket_endpoint(websocket: WebSocket, client_id: int):
 if __name__ == "__main__":
     data = init_data_file()
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # "auto" picks uvloop when it is installed (it has no Windows build)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="httptools",
+        ws="websockets",
+        reload=True,
+    )
 